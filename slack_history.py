@@ -1,10 +1,23 @@
 from slacker import Slacker
+import requests
 import json
 import argparse
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
 import os
-import shutil
-import copy
-from datetime import datetime
+import random
+import sys
+import tempfile
+import threading
+import time
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 # This script finds all channels, private channels and direct messages
 # that your user participates in, downloads the complete history for
@@ -25,56 +38,292 @@ from datetime import datetime
 #
 # dependencies:
 #	pip install slacker #https://github.com/os/slacker
+#	pip install orjson #optional, faster json encoding https://github.com/ijl/orjson
 #
 # usage examples
 #	python slack_history.py --token='123token'
 #	python slack_history.py --token='123token' --dryRun=True
 #	python slack_history.py --token='123token' --skipDirectMessages
 #	python slack_history.py --token='123token' --skipDirectMessages --skipPrivateChannels
+#	python slack_history.py --token='123token' --incremental
+#	python slack_history.py --token='123token' --excludeSubtypes=channel_join,channel_leave
+
+
+# buffer size for output files, large enough that a day's worth of messages
+# is flushed with a single write.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# gzip level for day files. the repetitive json compresses well even at a low
+# level, which keeps compression cheap next to the api calls.
+COMPRESS_LEVEL = 3
+
+# number of messages/items requested per page. slack caps history pages at
+# 1000 and recommends no more than 200 for the list methods.
+HISTORY_PAGE_SIZE = 1000
+LIST_PAGE_SIZE = 200
+
+# message fields whose values repeat across most messages of a room
+INTERNED_FIELDS = ('type', 'subtype', 'user', 'team', 'channel')
+
+# user and channel lists rarely change between runs, so they are cached on
+# disk and reused for this many seconds.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.slack_history_cache')
+CACHE_TTL = 600
+
+# lists already fetched during this run, keyed by cache key
+listCache = {}
+
+# maximum number of rooms whose history is fetched at the same time.
+# kept low so parallel fetches stay under slack's per-method rate limits.
+MAX_CONCURRENT_ROOMS = 8
+
+# pages of a room's history that may be fetched ahead of the writer
+HISTORY_QUEUE_SIZE = 4
+
+# every file system change made while fetching histories runs on this single
+# thread, off the event loop, so writes and channelRename never race.
+fileWriter = ThreadPoolExecutor(max_workers = 1)
+
+# api calls allowed per minute across all threads, per rate limit budget.
+# slack limits each api method separately. history calls make up the bulk of
+# the requests and slack allows ~50 per minute for them, calls to the stricter
+# list methods are few and rely on the retry below when limited. member lists
+# are tier 4 (~100 per minute) and get a budget of their own.
+REQUESTS_PER_MINUTE = {
+	'default': 45,
+	'members': 90
+}
+
+# times a rate limited (429) or failed (5xx) api call is retried before giving up
+MAX_RETRIES = 5
+
+# start times of the api calls made within the last minute, per budget
+requestTimes = collections.defaultdict(collections.deque)
+requestTimesLock = threading.Lock()
 
 
-# fetches the complete message history for a channel/group/im
+# blocks until another api call fits within the budget's REQUESTS_PER_MINUTE
+def waitForRateLimit(budget):
+	while(True):
+		with requestTimesLock:
+			times = requestTimes[budget]
+			now = time.monotonic()
+			while times and times[0] <= now - 60:
+				times.popleft()
+			if len(times) < REQUESTS_PER_MINUTE[budget]:
+				times.append(now)
+				return
+			wait = times[0] + 60 - now
+		time.sleep(wait)
+
+
+# calls a slacker api method, retrying when slack answers with an http error
+# that's worth another try.
+#
+# budget names the REQUESTS_PER_MINUTE entry the call counts against. rate
+# limited calls wait for as long as slack's Retry-After header asks, server
+# errors back off exponentially. a little jitter keeps concurrent fetches from
+# retrying in lockstep.
+def callSlack(method, *args, budget = 'default', **kwargs):
+	for attempt in range(MAX_RETRIES + 1):
+		waitForRateLimit(budget)
+		try:
+			return method(*args, **kwargs)
+		except requests.HTTPError as error:
+			status = error.response.status_code
+			if attempt == MAX_RETRIES or not (status == 429 or status >= 500):
+				raise
+			if status == 429:
+				delay = int(error.response.headers.get('Retry-After', 1))
+			else:
+				delay = min(60, 2 ** attempt)
+			time.sleep(delay + random.uniform(0, 1))
+
+
+# walks every page of a cursor paginated slack api method.
 #
-# pageableObject could be:
-# slack.channel
-# slack.groups
-# slack.im
+# fetchPage is called with the cursor of the page to fetch (None for the
+# first page) and returns the response body. the items found under itemKey
+# on each page are collected and returned as a single list.
+def getAllPages(fetchPage, itemKey):
+	items = []
+	cursor = None
+
+	while(True):
+		response = fetchPage(cursor)
+
+		items.extend(response[itemKey])
+
+		cursor = response.get('response_metadata', {}).get('next_cursor')
+		if not cursor:
+			break
+	return items
+
+
+# replaces the values of INTERNED_FIELDS with interned strings, so the
+# messages of a page share one copy of each instead of one per message.
+def internFields( messages ):
+	for message in messages:
+		for field in INTERNED_FIELDS:
+			value = message.get(field)
+			if isinstance(value, str):
+				message[field] = sys.intern(value)
+
+
+# fetches the complete message history for a channel/group/im, yielding it
+# one page of messages at a time (newest messages first) so the whole history
+# never has to be held in memory.
 #
 # channelId is the id of the channel/group/im you want to download history for.
-def getHistory(pageableObject, channelId, pageSize = 100):
-	messages = []
-	lastTimestamp = None
+# oldest is the slack timestamp of the oldest message to fetch, 0 fetches everything.
+async def iterHistory(slack, channelId, pageSize = HISTORY_PAGE_SIZE, oldest = 0):
+	loop = asyncio.get_running_loop()
+	cursor = None
 
 	while(True):
-		response = pageableObject.history(
+		request = functools.partial(
+			callSlack,
+			slack.conversations.history,
 			channel = channelId,
-			latest	= lastTimestamp,
-			oldest	= 0,
-			count	 = pageSize
-		).body
+			cursor	= cursor,
+			oldest	= oldest,
+			limit	 = pageSize
+		)
+		response = (await loop.run_in_executor(None, request)).body
 
-		messages.extend(response['messages'])
+		internFields(response['messages'])
+		yield response['messages']
 
-		if (response['has_more'] == True):
-			lastTimestamp = messages[-1]['ts'] # -1 means last element in a list
-		else:
+		cursor = response.get('response_metadata', {}).get('next_cursor')
+		if not cursor:
 			break
-	return messages
 
 
+# fetches all conversations of the given type(s) visible to the user
+#
+# types is a comma separated list of conversation types:
+# public_channel, private_channel, mpim, im
+def getConversations(slack, types):
+	return getAllPages(
+		lambda cursor: callSlack(
+			slack.conversations.list,
+			cursor	= cursor,
+			types	= types,
+			limit	= LIST_PAGE_SIZE
+		).body,
+		'channels')
+
+
+# fetches the user ids of every member of a conversation
+def getMembers(slack, channelId):
+	return getAllPages(
+		lambda cursor: callSlack(
+			slack.conversations.members,
+			budget	= 'members',
+			channel = channelId,
+			cursor	= cursor,
+			limit	= LIST_PAGE_SIZE
+		).body,
+		'members')
+
+
+# fetches all private channels and group dms (mpim), matching what the old
+# groups.list returned.
+def getGroups(slack):
+	return getConversations(slack, 'private_channel,mpim')
+
+
+# fills in the members and num_members of each conversation, which
+# conversations.list leaves out (num_members only some of the time), so
+# channels.json records look like the ones the old channels.list returned.
+# the member lists are fetched concurrently on the fetch thread pool.
+async def addMembers(slack, conversations):
+	loop = asyncio.get_running_loop()
+	memberLists = await asyncio.gather(*[
+		loop.run_in_executor(None, getMembers, slack, conversation['id'])
+		for conversation in conversations ])
+	for conversation, members in zip(conversations, memberLists):
+		conversation['members'] = members
+		conversation['num_members'] = len(members)
+
+
+# fetches all users in the slack organization
+def getUsers(slack):
+	# slacker's users.list doesn't take a cursor, so call the method directly
+	return getAllPages(
+		lambda cursor: callSlack(slack.users.get, 'users.list', params = {
+			'cursor': cursor,
+			'limit': LIST_PAGE_SIZE
+		}).body,
+		'members')
+
+
+# encode obj as utf-8 json bytes, using orjson when it's installed.
+#
+# pretty output is indented by two spaces, the only indent orjson supports,
+# otherwise the output is compact.
+def encodeJson(obj, pretty = False):
+	if orjson is not None:
+		return orjson.dumps(obj, option = orjson.OPT_INDENT_2 if pretty else 0)
+	if pretty:
+		return json.dumps(obj, indent = 2, ensure_ascii = False).encode('utf-8')
+	return json.dumps(obj, separators = (',', ':'), ensure_ascii = False).encode('utf-8')
+
+
+# decode json from bytes or str, using orjson when it's installed
+def decodeJson(data):
+	if orjson is not None:
+		return orjson.loads(data)
+	return json.loads(data)
+
+
+# directories created (or found to exist) by mkdir during this run
+knownDirs = set()
+
 def mkdir(directory):
-	if not os.path.isdir(directory):
-		os.makedirs(directory)
+	if directory in knownDirs:
+		return
+	os.makedirs(directory, exist_ok = True)
+	knownDirs.add(directory)
 
 
-# create datetime object from slack timestamp ('ts') string
-def parseTimeStamp( timeStamp ):
-	if '.' in timeStamp:
-		t_list = timeStamp.split('.')
-		if len( t_list ) != 2:
-			raise ValueError( 'Invalid time stamp' )
-		else:
-			return datetime.utcfromtimestamp( float(t_list[0]) )
+# returns the list stored under key, calling fetchList to build it only if it
+# hasn't been fetched during this run or cached on disk within the last ttl seconds.
+def cachedList(key, fetchList, ttl = CACHE_TTL):
+	if key in listCache:
+		return listCache[key]
+
+	fileName = os.path.join(CACHE_DIR, key + '.json')
+	if os.path.isfile(fileName) and os.path.getmtime(fileName) > time.time() - ttl:
+		with open(fileName, 'rb') as cacheFile:
+			items = decodeJson(cacheFile.read())
+	else:
+		items = fetchList()
+		mkdir(CACHE_DIR)
+		# write to a temporary file and move it into place, so an interrupted
+		# run never leaves a truncated cache file behind
+		fd, tempName = tempfile.mkstemp(dir = CACHE_DIR, suffix = '.tmp')
+		with open(fd, 'wb', buffering=WRITE_BUFFER_SIZE) as cacheFile:
+			cacheFile.write(encodeJson(items))
+		os.replace(tempName, fileName)
+
+	listCache[key] = items
+	return items
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# returns the utc day (days since the epoch) a slack timestamp ('ts') string falls on.
+#
+# called once per message, so it sticks to integer maths on the seconds part
+# rather than building a datetime.
+def getDay( timeStamp ):
+	return int( timeStamp.partition('.')[0] ) // SECONDS_PER_DAY
+
+
+# returns the YYYY-MM-DD date of a day number from getDay
+def formatDay( day ):
+	return time.strftime( '%Y-%m-%d', time.gmtime( day * SECONDS_PER_DAY ) )
 
 
 # move channel files from old directory to one with new channel name
@@ -83,56 +332,164 @@ def channelRename( oldRoomName, newRoomName ):
 	if not os.path.isdir( oldRoomName ):
 		return
 	mkdir( newRoomName )
-	for fileName in os.listdir( oldRoomName ):
-		shutil.move( os.path.join( oldRoomName, fileName ), newRoomName )
+	# both directories live under the same parent, so a plain rename is enough
+	with os.scandir( oldRoomName ) as entries:
+		for entry in entries:
+			os.rename( entry.path, os.path.join( newRoomName, entry.name ) )
 	os.rmdir( oldRoomName )
+	knownDirs.discard( oldRoomName )
+
+
+# returns the timestamp of the newest message in an existing day file, or
+# None if the file doesn't exist yet.
+def getLastTimeStamp( fileName ):
+	if not os.path.isfile( fileName ):
+		return None
+
+	lastLine = b''
+	with gzip.open( fileName, 'rb' ) as inFile:
+		for line in inFile:
+			if line.strip():
+				lastLine = line
+	if not lastLine:
+		return None
+	return decodeJson( lastLine )['ts']
+
 
+# returns the timestamp of the newest message saved in a room's directory, or
+# 0 if nothing has been saved for it yet.
+def getNewestTimeStamp( roomPath ):
+	if not os.path.isdir( roomPath ):
+		return 0
 
-def writeMessageFile( fileName, messages ):
-	directory = os.path.dirname(fileName)
+	# day files are named by date, so the newest messages are in the last one
+	with os.scandir( roomPath ) as entries:
+		dayFiles = [ entry.name for entry in entries if entry.name.endswith('.jsonl.gz') ]
+	if not dayFiles:
+		return 0
+	return getLastTimeStamp( os.path.join( roomPath, max(dayFiles) ) ) or 0
 
-	if not os.path.isdir( directory ):
-		mkdir( directory )
 
-	with open(fileName, 'w') as outFile:
-		json.dump( messages, outFile, indent=4)
+# write a day's messages as gzipped json lines, one message per line, oldest first.
+#
+# messages are given newest first, as slack returns them. with incremental
+# set, an existing file is appended to with only the messages newer than the
+# ones it already holds.
+def writeMessageFile( fileName, messages, incremental = False ):
+	# free while the directory is known, and brings it back if a rename of
+	# another room removed it
+	mkdir( os.path.dirname( fileName ) )
+
+	mode = 'wb'
+	if incremental:
+		lastTimeStamp = getLastTimeStamp( fileName )
+		if lastTimeStamp is not None:
+			# slack timestamps are fixed width, so they compare correctly as strings
+			messages = [ message for message in messages if message['ts'] > lastTimeStamp ]
+			mode = 'ab'
+			if not messages:
+				return
+
+	# appending adds another gzip member, which gzip readers handle transparently
+	with gzip.open(fileName, mode, compresslevel=COMPRESS_LEVEL) as outFile:
+		outFile.write( b'\n'.join( encodeJson( message ) for message in reversed(messages) ) + b'\n' )
+
+
+# fetch every page of a room's history newer than oldest onto queue, followed
+# by None once the history is exhausted.
+async def queueHistory( slack, roomId, oldest, queue ):
+	async for messages in iterHistory(slack, roomId, oldest = oldest):
+		await queue.put( messages )
+	await queue.put( None )
 
 
 # parse messages by date
-def parseMessages( parentDir, roomDir, messages, roomType ):
+#
+# pages are taken off queue as queueHistory fetches them. a day's file is
+# written as soon as a message from an earlier day shows up, so only a few
+# pages and the current day's messages are held in memory.
+#
+# each message sent by a user also gets a user_name field looked up in
+# userIdNameMap, so the output can be read without joining against users.json.
+#
+# messages whose subtype is in excludeSubtypes are left out, except for name
+# changes which are always kept.
+#
+# roomNames holds the current names of all rooms exported under parentDir.
+# directories under those names belong to a live room, so a name change from
+# one of them never merges it into this room.
+async def parseMessages( parentDir, roomDir, queue, roomType, roomNames, userIdNameMap, excludeSubtypes, incremental ):
+	loop = asyncio.get_running_loop()
 	nameChangeFlag = roomType + "_name"
+	excludeSubtypes = excludeSubtypes - { nameChangeFlag }
+	roomPath = '{parent}/{room}'.format( parent = parentDir, room = roomDir )
+	await loop.run_in_executor( fileWriter, mkdir, roomPath )
+	filePrefix = roomPath + '/'
 
-	currentFileDate = ''
+	currentDay = None
 	currentMessages = []
-	for message in messages:
-		#first store the date of the next message
-		ts = parseTimeStamp( message['ts'] )
-		fileDate = '{:%Y-%m-%d}'.format(ts)
-
-		#if it's on a different day, write out the previous day's messages
-		if fileDate != currentFileDate:
-			outFileName = '{parent}/{room}/{file}.json'.format( parent = parentDir, room = roomDir, file = currentFileDate )
-			writeMessageFile( outFileName, currentMessages )
-			currentFileDate = fileDate
-			currentMessages = []
-
-		# check if current message is a name change
-		# dms won't have name change events
-		if roomType != "im" and ( 'subtype' in message ) and message['subtype'] == nameChangeFlag:
-			roomDir = message['name']
-			oldRoomPath = '{parent}/{room}'.format( parent = parentDir, room = message['old_name'] )
-			newRoomPath = '{parent}/{room}'.format( parent = parentDir, room = roomDir )
-			channelRename( oldRoomPath, newRoomPath )
-
-		currentMessages.append( message )
-	outFileName = '{parent}/{room}/{file}.json'.format( parent = parentDir, room = roomDir, file = currentFileDate )
-	writeMessageFile( outFileName, currentMessages )
+	while(True):
+		messages = await queue.get()
+		if messages is None:
+			break
 
+		# name changes are rare, so look for them in one pass over the page and
+		# move any files saved under an old name into the room's current
+		# directory up front. dms won't have name change events.
+		if roomType != "im":
+			for message in [ message for message in messages if message.get('subtype') == nameChangeFlag ]:
+				if message['old_name'] not in roomNames:
+					oldRoomPath = '{parent}/{room}'.format( parent = parentDir, room = message['old_name'] )
+					await loop.run_in_executor( fileWriter, channelRename, oldRoomPath, roomPath )
+
+		for message in messages:
+			if message.get('subtype') in excludeSubtypes:
+				continue
+
+			#first store the day of the next message
+			day = getDay( message['ts'] )
+
+			#if it's on a different day, write out the previous day's messages
+			if day != currentDay:
+				if currentMessages:
+					await loop.run_in_executor( fileWriter, writeMessageFile, filePrefix + formatDay( currentDay ) + '.jsonl.gz', currentMessages, incremental )
+				currentDay = day
+				currentMessages = []
+
+			userId = message.get('user')
+			if userId:
+				message['user_name'] = userIdNameMap.get(userId)
+
+			currentMessages.append( message )
+	if currentMessages:
+		await loop.run_in_executor( fileWriter, writeMessageFile, filePrefix + formatDay( currentDay ) + '.jsonl.gz', currentMessages, incremental )
 
-# fetch and write history for all public channels
-def getChannels(slack, dryRun):
-	channels = slack.channels.list().body['channels']
 
+# fetch and write history for a single channel/group/im.
+#
+# the blocking slacker calls run on the fetch thread pool so that several
+# rooms can be in flight at once. pages are handed over through a small queue
+# so the next page is fetched while the previous one is being written.
+#
+# with incremental set, only messages newer than the ones already saved for
+# the room are fetched. roomLabel describes the room in the progress output.
+async def getRoomHistory(semaphore, slack, roomId, roomLabel, parentDir, roomDir, roomType, roomNames, userIdNameMap, excludeSubtypes, incremental):
+	loop = asyncio.get_running_loop()
+	async with semaphore:
+		print("getting history for {0}".format(roomLabel))
+		oldest = 0
+		if incremental:
+			roomPath = '{parent}/{room}'.format( parent = parentDir, room = roomDir )
+			oldest = await loop.run_in_executor( fileWriter, getNewestTimeStamp, roomPath )
+
+		queue = asyncio.Queue( maxsize = HISTORY_QUEUE_SIZE )
+		await asyncio.gather(
+			queueHistory( slack, roomId, oldest, queue ),
+			parseMessages( parentDir, roomDir, queue, roomType, roomNames, userIdNameMap, excludeSubtypes, incremental ))
+
+
+# fetch and write history for all public channels
+async def getChannels(slack, channels, userIdNameMap, excludeSubtypes, dryRun, incremental):
 	print("\nfound channels: ")
 	for channel in channels:
 		print(channel['name'])
@@ -140,48 +497,49 @@ def getChannels(slack, dryRun):
 	if not dryRun:
 		parentDir = "channel"
 		mkdir(parentDir)
+		semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROOMS)
+		channelNames = set( channel['name'] for channel in channels )
+		fetches = []
 		for channel in channels:
-			print("getting history for channel {0}".format(channel['name']))
+			channelLabel = "channel {0}".format(channel['name'])
 			channelDir = channel['name']
-			mkdir( os.path.join( parentDir, channelDir ) )
-			messages = getHistory(slack.channels, channel['id'])
-			parseMessages( parentDir, channelDir, messages, 'channel')
+			fetches.append(getRoomHistory(semaphore, slack, channel['id'], channelLabel, parentDir, channelDir, 'channel', channelNames, userIdNameMap, excludeSubtypes, incremental))
+		await asyncio.gather(*fetches)
 
 
 # write channels.json file
-def dumpChannelFile( slack ):
+def dumpChannelFile( channels, groups ):
 	print("Making channels file")
-	channels = slack.channels.list().body['channels']
+	#copy so the private channels added below don't end up in the caller's list
+	channels = list(channels)
 
 	#have to convert private channels to channels to be read in properly
-	groups = slack.groups.list().body['groups']
-	print( str(len(channels) ) )
 	for group in groups:
-		print( str(len(channels) ) )
-		new_channel = copy.copy(channels[0])
-		new_channel['id'] = group['id']
-		new_channel['name'] = group['name']
-		new_channel['created'] = group['created']
-		new_channel['creator'] = group['creator']
-		new_channel['is_archived'] = group['is_archived']
-		new_channel['is_channel'] = True
-		new_channel['is_general'] = False
-		new_channel['is_member'] = True
-		new_channel['members'] = group['members']
-		new_channel['num_members'] = len(group['members'])
-		new_channel['purpose'] = group['purpose']
-		new_channel['topic'] = group['topic']
+		new_channel = {
+			'id': group['id'],
+			'name': group['name'],
+			'created': group['created'],
+			'creator': group['creator'],
+			'is_archived': group['is_archived'],
+			'is_channel': True,
+			'is_general': False,
+			'is_member': True,
+			'members': group['members'],
+			'num_members': len(group['members']),
+			'purpose': group['purpose'],
+			'topic': group['topic']
+		}
 		channels.append( new_channel )
 
 	#We will be overwriting this file on each run.
-	with open('channels.json', 'w') as outFile:
-		json.dump( channels , outFile, indent=4)
+	with open('channels.json', 'wb', buffering=WRITE_BUFFER_SIZE) as outFile:
+		outFile.write( encodeJson( channels, pretty=True ) )
 
 
 # fetch and write history for all direct message conversations
 # also known as IMs in the slack API.
-def getDirectMessages(slack, ownerId, userIdNameMap, dryRun):
-	dms = slack.im.list().body['ims']
+async def getDirectMessages(slack, ownerId, userIdNameMap, excludeSubtypes, dryRun, incremental):
+	dms = getConversations(slack, 'im')
 
 	print("\nfound direct messages (1:1) with the following users:")
 	for dm in dms:
@@ -190,39 +548,41 @@ def getDirectMessages(slack, ownerId, userIdNameMap, dryRun):
 	if not dryRun:
 		parentDir = "direct_message"
 		mkdir(parentDir)
+		semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROOMS)
+		fetches = []
 		for dm in dms:
 			name = userIdNameMap.get(dm['user'], dm['user'] + " (name unknown)")#note: double check naming of dm directory
-			print("getting history for direct messages with {0}".format(name))
+			dmLabel = "direct messages with {0}".format(name)
 			dmDir = name
-			mkdir('{parent}/{dm}'.format( parent = parentDir, dm = dmDir ))
-			messages = getHistory(slack.im, dm['id'])
-			parseMessages( parentDir, dmDir, messages, "im" )
+			fetches.append(getRoomHistory(semaphore, slack, dm['id'], dmLabel, parentDir, dmDir, "im", set(), userIdNameMap, excludeSubtypes, incremental))
+		await asyncio.gather(*fetches)
 
 
 # fetch and write history for all private channels
 # also known as groups in the slack API.
-def getPrivateChannels(slack, dryRun):
-	groups = slack.groups.list().body['groups']
-
+async def getPrivateChannels(slack, groups, userIdNameMap, excludeSubtypes, dryRun, incremental):
 	print("\nfound private channels:")
 	for group in groups:
-		print("{0}: ({1} members)".format(group['name'], len(group['members'])))
+		# dry runs don't fetch member lists
+		if 'members' in group:
+			print("{0}: ({1} members)".format(group['name'], len(group['members'])))
+		else:
+			print(group['name'])
 
 	if not dryRun:
 		parentDir = "private_channels"
 		mkdir(parentDir)
+		semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROOMS)
+		groupNames = set( group['name'] for group in groups )
+		fetches = []
 		for group in groups:
-			messages = []
-			print("getting history for private channel {0} with id {1}".format(group['name'], group['id']))
+			groupLabel = "private channel {0} with id {1}".format(group['name'], group['id'])
 			groupDir = group['name']
-			mkdir( '{parent}/{group}'.format( parent = parentDir, group = groupDir ) )
-			messages = getHistory(slack.groups, group['id'])
-			parseMessages( parentDir, groupDir, messages, 'group' )
-
-# fetch all users for the channel and return a map userId -> userName
-def getUserMap(slack):
-	#get all users in the slack organization
-	users = slack.users.list().body['members']
+			fetches.append(getRoomHistory(semaphore, slack, group['id'], groupLabel, parentDir, groupDir, 'group', groupNames, userIdNameMap, excludeSubtypes, incremental))
+		await asyncio.gather(*fetches)
+
+# return a map userId -> userName for all users in the slack organization
+def getUserMap(users):
 	userIdNameMap = {}
 	for user in users:
 		userIdNameMap[user['id']] = user['name']
@@ -230,19 +590,68 @@ def getUserMap(slack):
 	return userIdNameMap
 
 # stores json of user info
-def dumpUserFile(slack):
+def dumpUserFile(users):
 	#write to user file, any existing file needs to be overwritten.
-	with open( "users.json", 'w') as userFile:
-		json.dump( slack.users.list().body['members'], userFile, indent=4 )
+	with open( "users.json", 'wb', buffering=WRITE_BUFFER_SIZE) as userFile:
+		userFile.write( encodeJson( users, pretty=True ) )
 
 # get basic info about the slack channel to ensure the authentication token works
 def doTestAuth(slack):
-	testAuth = slack.auth.test().body
+	testAuth = callSlack(slack.auth.test).body
 	teamName = testAuth['team']
 	currentUser = testAuth['user']
 	print("Successfully authenticated for team {0} and user {1} ".format(teamName, currentUser))
 	return testAuth
 
+async def main(args):
+	# one worker per room that may be fetched at the same time
+	asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers = MAX_CONCURRENT_ROOMS))
+
+	# share one connection pool between all api calls so https connections
+	# are reused instead of paying a new handshake per request, with enough
+	# connections for every concurrent fetch.
+	session = requests.Session()
+	session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize = MAX_CONCURRENT_ROOMS))
+
+	slack = Slacker(args.token, session = session)
+
+	testAuth = doTestAuth(slack)
+
+	#cached lists are per team, the same cache dir may be used with several tokens.
+	#private channels and group dms depend on who is asking, so they are per user too.
+	teamId = testAuth['team_id']
+	userKey = teamId + '_' + testAuth['user_id']
+
+	users = cachedList(teamId + '_users', lambda: getUsers(slack))
+	userIdNameMap = getUserMap(users)
+
+	dryRun = args.dryRun
+
+	excludeSubtypes = set( subtype for subtype in args.excludeSubtypes.split(',') if subtype )
+
+	if not dryRun or not args.skipChannels:
+		channels = cachedList(teamId + '_channels', lambda: getConversations(slack, 'public_channel'))
+
+	if not dryRun or not args.skipPrivateChannels:
+		groups = cachedList(userKey + '_groups', lambda: getGroups(slack))
+
+	if not dryRun:
+		#member lists are only needed for channels.json, so dry runs skip them
+		await addMembers(slack, channels + groups)
+
+		#write channel and user jsons
+		dumpUserFile(users)
+		dumpChannelFile(channels, groups)
+
+	if not args.skipChannels:
+		await getChannels(slack, channels, userIdNameMap, excludeSubtypes, dryRun, args.incremental)
+
+	if not args.skipPrivateChannels:
+		await getPrivateChannels(slack, groups, userIdNameMap, excludeSubtypes, dryRun, args.incremental)
+
+	if not args.skipDirectMessages:
+		await getDirectMessages(slack, testAuth['user_id'], userIdNameMap, excludeSubtypes, dryRun, args.incremental)
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='download slack history')
 
@@ -272,26 +681,17 @@ if __name__ == "__main__":
 		default=False,
 		help="skip fetching history for directMessages")
 
-	args = parser.parse_args()
-
-	slack = Slacker(args.token)
-
-	testAuth = doTestAuth(slack)
-
-	userIdNameMap = getUserMap(slack)
-
-	dryRun = args.dryRun
-
-	if not dryRun:
-		#write channel and user jsons
-		dumpUserFile(slack)
-		dumpChannelFile(slack)
+	parser.add_argument(
+		'--incremental',
+		action='store_true',
+		default=False,
+		help="append only new messages to existing day files instead of overwriting them")
 
-	if not args.skipChannels:
-		getChannels(slack, dryRun)
+	parser.add_argument(
+		'--excludeSubtypes',
+		default='',
+		help="comma separated message subtypes to leave out, e.g. channel_join,channel_leave")
 
-	if not args.skipPrivateChannels:
-		getPrivateChannels(slack, dryRun)
+	args = parser.parse_args()
 
-	if not args.skipDirectMessages:
-		getDirectMessages(slack, testAuth['user_id'], userIdNameMap, dryRun)
+	asyncio.run(main(args))